@@ -0,0 +1,250 @@
+import re
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+import openai.util
+import memgpt.agent
+import memgpt.memory
+
+
+RECORD = "record"
+REPLAY = "replay"
+CHAT_COMPLETION = "chat_completion"
+EMBEDDING = "embedding"
+
+# memgpt.utils.get_local_time, e.g. "2023-11-07 05:22:19 PM PST-0800"
+LOCAL_TIME = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} [AP]M [A-Za-z]*[+-]\d{4}")
+
+
+# module attributes the capture patches or relies on, checked before installing
+HOOKS = (
+    (memgpt.agent, "chat_completion_with_backoff"),
+    (memgpt.memory, "chat_completion_with_backoff"),
+    (memgpt.memory, "embedding_model"),
+    (openai.util, "convert_to_openai_object"),
+)
+
+
+class CaptureUnsupported(Exception):
+    """Raised when the installed MemGPT or openai lacks an attribute the capture hooks into"""
+
+
+class ReplayMismatch(Exception):
+    """Raised when a replayed run asks for something that was not recorded"""
+
+
+def normalize_request(value):
+    """
+    Make a recorded or live request comparable: JSON types only, local timestamps masked
+
+    :param value: Request value, e.g. messages or functions
+    :return: Normalized value
+    """
+    return json.loads(LOCAL_TIME.sub("<time>", json.dumps(value, default=str)))
+
+
+class CapturedEmbeddings():
+    """
+    Stand-in for the embedding model of archival memory, recording or replaying get_text_embedding
+
+    :param capture: Capture the calls go through
+    :param embed_model: Factory of the real embedding model, only built when recording
+    """
+
+    def __init__(self, capture: "LLMCapture", embed_model: Callable) -> None:
+        self.capture = capture
+        self.embed_model = embed_model() if capture.mode == RECORD else None
+
+    def get_text_embedding(self, text: str):
+        if self.capture.mode == REPLAY:
+            return self.capture.replay_embedding(text)
+
+        started_at = time.time()
+        embedding = self.embed_model.get_text_embedding(text)
+        self.capture.write({
+            "kind": EMBEDDING,
+            "started_at": started_at,
+            "duration": time.time() - started_at,
+            "text": text,
+            "embedding": [float(value) for value in embedding],
+        })
+        return embedding
+
+
+class LLMCapture():
+    """
+    Record or replay the model and embedding calls made during agent.step
+
+    In record mode every request, response and timing is appended to a JSONL capture file.
+    In replay mode chat completions are served from that file per session and in recorded order,
+    after checking the messages and functions match the recorded request, and embeddings by text.
+
+    Live sessions not found in the capture (e.g. new IDs from /chat/init) are bound to the
+    recorded sessions not seen yet, in the order those first appear in the capture file.
+
+    :param mode: "record" or "replay"
+    :param path: Path of the JSONL capture file
+    :param speed: Replay speed factor, 1 waits the recorded duration, 0 does not wait
+    """
+
+    def __init__(self, mode: str, path: str, speed: float = 0) -> None:
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown capture mode: {mode}")
+        self.mode = mode
+        self.path = path
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.replay_queues: Optional[OrderedDict] = None
+        self.embeddings: dict = {}
+        self.session_map: dict = {}
+
+    def wrap(self, completion: Callable) -> Callable:
+        """
+        Wrap a chat completion function with signature (agent_config, **kwargs)
+
+        :param completion: Chat completion function
+        :return: Recording or replaying chat completion function
+        """
+        def chat_completion(agent_config, **kwargs):
+            if self.mode == REPLAY:
+                return self.replay(agent_config.name, kwargs)
+            return self.record(completion, agent_config, **kwargs)
+
+        return chat_completion
+
+    def write(self, interaction: dict) -> None:
+        line = json.dumps(interaction, default=str)
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(line + "\n")
+
+    def record(self, completion: Callable, agent_config, **kwargs):
+        """
+        Call the model and append the interaction to the capture file
+
+        :param completion: Chat completion function
+        :param agent_config: Config of the calling agent
+        :return: Model response
+        """
+        started_at = time.time()
+        response = completion(agent_config, **kwargs)
+        duration = time.time() - started_at
+
+        self.write({
+            "kind": CHAT_COMPLETION,
+            "session": agent_config.name,
+            "started_at": started_at,
+            "duration": duration,
+            "request": kwargs,
+            "response": response,
+        })
+
+        return response
+
+    def replay(self, session: str, request: dict):
+        """
+        Serve the next recorded response of a session
+
+        :param session: Session ID of the calling agent
+        :param request: Keyword arguments of the live chat completion call
+        :return: Model response
+        """
+        with self.lock:
+            self.load()
+            recorded_session = self.recorded_session(session)
+            queue = self.replay_queues[recorded_session]
+            if not queue:
+                raise ReplayMismatch(f"No recorded model response left for session {session} (recorded as {recorded_session})")
+            interaction = queue.popleft()
+
+        for field in ("messages", "functions"):
+            if normalize_request(request.get(field)) != normalize_request(interaction["request"].get(field)):
+                raise ReplayMismatch(f"Session {session} diverged from the capture: {field} differ from the recorded request")
+
+        self.wait(interaction)
+        return openai.util.convert_to_openai_object(interaction["response"])
+
+    def replay_embedding(self, text: str):
+        """
+        Serve the recorded embedding of a text
+
+        :param text: Embedded text
+        :return: Embedding
+        """
+        with self.lock:
+            self.load()
+            interaction = self.embeddings.get(text)
+        if interaction is None:
+            raise ReplayMismatch(f"No recorded embedding for text: {text[:80]!r}")
+
+        self.wait(interaction)
+        return interaction["embedding"]
+
+    def wait(self, interaction: dict) -> None:
+        if self.speed > 0:
+            time.sleep(interaction["duration"] / self.speed)
+
+    def recorded_session(self, session: str) -> str:
+        """
+        Map a live session ID to a recorded one, binding new IDs to the next unclaimed recorded session
+
+        :param session: Session ID of the calling agent
+        :return: Recorded session ID
+        """
+        if session not in self.session_map:
+            if session in self.replay_queues:
+                self.session_map[session] = session
+            else:
+                claimed = set(self.session_map.values()) | set(self.session_map)
+                unclaimed = [recorded for recorded in self.replay_queues if recorded not in claimed]
+                if not unclaimed:
+                    raise ReplayMismatch(f"No recorded session left to replay session {session}")
+                self.session_map[session] = unclaimed[0]
+        return self.session_map[session]
+
+    def load(self) -> None:
+        """
+        Load the capture file into per-session queues and an embedding lookup, once
+        """
+        if self.replay_queues is not None:
+            return
+
+        queues = OrderedDict()
+        with open(self.path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                if interaction.get("kind", CHAT_COMPLETION) == EMBEDDING:
+                    self.embeddings[interaction["text"]] = interaction
+                else:
+                    queues.setdefault(interaction["session"], deque()).append(interaction)
+        self.replay_queues = queues
+
+
+def install_capture(mode: str, path: str, speed: float = 0) -> LLMCapture:
+    """
+    Route the model calls of memgpt agents and summarizer, and the embedding calls
+    of archival memory, through a capture
+
+    :param mode: "record" or "replay"
+    :param path: Path of the JSONL capture file
+    :param speed: Replay speed factor
+    :return: Installed capture
+    """
+    missing = [f"{module.__name__}.{name}" for module, name in HOOKS if not hasattr(module, name)]
+    if missing:
+        raise CaptureUnsupported(
+            f"LLM capture hooks into {', '.join(missing)}, not found in the installed packages (supported: pymemgpt==0.2.4)"
+        )
+
+    capture = LLMCapture(mode, path, speed)
+    memgpt.agent.chat_completion_with_backoff = capture.wrap(memgpt.agent.chat_completion_with_backoff)
+    memgpt.memory.chat_completion_with_backoff = capture.wrap(memgpt.memory.chat_completion_with_backoff)
+
+    embedding_model = memgpt.memory.embedding_model
+    memgpt.memory.embedding_model = lambda: CapturedEmbeddings(capture, embedding_model)
+    return capture
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import signal
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import anyio
+
+from memgpt_api import MemGptAPI, warm_agents
+
+
+class WorkerDraining(Exception):
+    """Raised when a turn is started while the worker is shutting down"""
+
+
+class Worker():
+    """
+    Lifecycle of an API worker: tracks in-flight turns, drains and flushes them on shutdown
+    and hands the hot sessions over to the next process so it can pre-warm them.
+
+    :param hot_sessions_file: Path of the hot sessions list written on shutdown
+    :param drain_timeout: Seconds from the shutdown signal to wait for in-flight turns, later ones are abandoned
+    :param max_hot_sessions: Maximum number of sessions handed over
+    """
+
+    def __init__(self, hot_sessions_file: str, drain_timeout: float, max_hot_sessions: int) -> None:
+        self.hot_sessions_file = hot_sessions_file
+        self.drain_timeout = drain_timeout
+        self.max_hot_sessions = max_hot_sessions
+        self.accepting = True
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.deadline: Optional[float] = None
+        self.last_seen: OrderedDict = OrderedDict()
+
+    def install_signal_handlers(self) -> None:
+        """
+        Stop accepting turns as soon as SIGTERM/SIGINT arrive, before the server
+        waits for open connections, then hand the signal to the previous handler
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            previous = signal.getsignal(signum)
+
+            def handler(signum, frame, previous=previous):
+                self.stop_accepting()
+                if callable(previous):
+                    previous(signum, frame)
+                else:
+                    signal.signal(signum, previous)
+                    signal.raise_signal(signum)
+
+            try:
+                signal.signal(signum, handler)
+            except ValueError:
+                # not running in the main thread, e.g. under a test client
+                return
+
+    def stop_accepting(self) -> None:
+        """
+        Refuse new turns and start the drain deadline, once
+        """
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.drain_timeout
+        self.accepting = False
+
+    @asynccontextmanager
+    async def turn(self, session_id: str):
+        """
+        Track one agent turn, refused once draining has started
+
+        :param session_id: Session ID for agent
+        """
+        if not self.accepting:
+            raise WorkerDraining()
+
+        self.in_flight += 1
+        self.idle.clear()
+        self.last_seen[session_id] = time.time()
+        self.last_seen.move_to_end(session_id)
+        while len(self.last_seen) > self.max_hot_sessions:
+            self.last_seen.popitem(last=False)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.set()
+
+    async def warm(self) -> None:
+        """
+        Pre-warm the sessions handed over by the previous process
+        """
+        for session_id in self.read_hot_sessions():
+            if not self.accepting:
+                return
+            try:
+                await anyio.to_thread.run_sync(MemGptAPI(session_id).warm)
+            except Exception as err:
+                print(f"Error warming session {session_id}", str(err))
+
+    async def drain(self) -> None:
+        """
+        Stop accepting turns, wait for in-flight ones until the deadline started by the
+        shutdown signal, abandon the rest and write the hot sessions list
+        """
+        self.stop_accepting()
+        try:
+            await asyncio.wait_for(self.idle.wait(), self.remaining())
+        except asyncio.TimeoutError:
+            print(f"Drain timed out with {self.in_flight} turns in flight")
+
+        # turns whose request was cancelled by the server may still run in worker threads
+        abandoned = await anyio.to_thread.run_sync(warm_agents.flush, self.remaining())
+        if abandoned:
+            print(f"Abandoned unfinished turns of {len(abandoned)} sessions, their last save is kept")
+        self.write_hot_sessions()
+
+    def remaining(self) -> float:
+        """
+        :return: Seconds left before the drain deadline
+        """
+        return max(0.0, self.deadline - time.monotonic())
+
+    def hot_sessions(self) -> List[str]:
+        """
+        :return: Warm and recently used session IDs, most recent first
+        """
+        sessions = {session_id: 0.0 for session_id in warm_agents.sessions()}
+        sessions.update(self.last_seen)
+        ranked = sorted(sessions, key=sessions.get, reverse=True)
+        return ranked[:self.max_hot_sessions]
+
+    def write_hot_sessions(self) -> None:
+        tmp_file = f"{self.hot_sessions_file}.tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(self.hot_sessions(), file)
+        os.replace(tmp_file, self.hot_sessions_file)
+
+    def read_hot_sessions(self) -> List[str]:
+        try:
+            with open(self.hot_sessions_file, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+        except ValueError as err:
+            print("Error reading hot sessions", str(err))
+            return []
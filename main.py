@@ -1,22 +1,47 @@
 import os
 import uuid
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
 from typing import Optional
 from datetime import date
 
+import anyio
 from dotenv import load_dotenv
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, HTTPException, Request, WebSocket, status
 from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.websockets import WebSocketDisconnect
-from utils import stream_response
+from utils import stream_response, stream_ndjson, read_ndjson, read_ndjson_file, iterate_from_thread, merge_session_records, spool_session_records, NDJSONError
 
-from memgpt_api import MemGptAPI
+from memgpt_api import MemGptAPI, WARM_SESSIONS, SessionNotFound, InvalidMemoryRecord, CoreMemoryLimitExceeded
+from lifecycle import Worker, WorkerDraining
 
-from schemas import Session, Message, RecallMemoryStats
+from schemas import Session, Message, RecallMemoryStats, MemoryExport, MemoryImportStats, MemoriesImportStats, CoreMemory, CoreMemoryUpdate
 
 load_dotenv()
 
-app = FastAPI()
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", 4))
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+HOT_SESSIONS_FILE = os.getenv("HOT_SESSIONS_FILE", "hot_sessions.json")
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 8))
+
+worker = Worker(HOT_SESSIONS_FILE, DRAIN_TIMEOUT, WARM_SESSIONS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Pre-warm hot sessions on startup, drain and flush on shutdown
+    """
+    worker.install_signal_handlers()
+    warming = asyncio.create_task(worker.warm())
+    yield
+    warming.cancel()
+    await worker.drain()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 origins = [
@@ -234,11 +259,16 @@ async def socket_chat(websocket: WebSocket, session_id: str):
                 prompt = await websocket.receive_text()
                 print("Waiting for api response......")
 
-                message = memgpt_api.send_message(prompt)
+                async with worker.turn(session_id):
+                    message = await anyio.to_thread.run_sync(memgpt_api.send_message, prompt)
                 await websocket.send_text(message)
         except WebSocketDisconnect:
             print("Client disconnected")
 
+    except WorkerDraining:
+        # 1012: service restart, the client should reconnect to another worker
+        await websocket.close(code=1012)
+
     except Exception as err:
         print(err)
         await websocket.close()
@@ -252,7 +282,11 @@ async def streaming_chat(session_id: str, message: Message):
     :param session_id: Session ID for agent
     """
     memgpt_api = MemGptAPI(session_id)
-    message = memgpt_api.send_message(message.prompt)
+    try:
+        async with worker.turn(session_id):
+            message = await anyio.to_thread.run_sync(memgpt_api.send_message, message.prompt)
+    except WorkerDraining:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Worker is restarting", headers={"Retry-After": "1"})
 
     return StreamingResponse(stream_response(message), media_type="text/event-stream")
 
@@ -279,3 +313,137 @@ async def search_recall_memory(session_id: str, start_date: Optional[date] = Non
     """
     memgpt_api = MemGptAPI(session_id)
     return memgpt_api.search_recall_memory(start_date, end_date, text_search)
+
+
+@app.get("/memory/{session_id}/core", response_model=CoreMemory)
+async def core_memory(session_id: str):
+    """
+    Core memory (persona and human blocks)
+
+    :param session_id: Session ID for agent
+    """
+    memgpt_api = MemGptAPI(session_id)
+    try:
+        core = await anyio.to_thread.run_sync(memgpt_api.get_core_memory)
+    except SessionNotFound as err:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(err))
+
+    return CoreMemory(**core)
+
+
+@app.patch("/memory/{session_id}/core", response_model=CoreMemory)
+async def update_core_memory(session_id: str, update: CoreMemoryUpdate):
+    """
+    Edit core memory in place
+
+    :param session_id: Session ID for agent
+    :param update: New persona and/or human blocks
+    """
+    memgpt_api = MemGptAPI(session_id)
+    try:
+        async with worker.turn(session_id):
+            core = await anyio.to_thread.run_sync(memgpt_api.update_core_memory, update.persona, update.human)
+    except WorkerDraining:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Worker is restarting", headers={"Retry-After": "1"})
+    except SessionNotFound as err:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(err))
+    except CoreMemoryLimitExceeded as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
+
+    return CoreMemory(**core)
+
+
+def ndjson_response(records, compress: bool) -> StreamingResponse:
+    """
+    Build a streaming NDJSON response, gzip encoded if requested
+
+    :param records: Records to stream
+    :param compress: Gzip the response body
+    """
+    headers = {"Content-Encoding": "gzip"} if compress else None
+    return StreamingResponse(stream_ndjson(records, compress), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+
+@app.get("/memory/{session_id}/export", response_class=StreamingResponse)
+async def export_memory(session_id: str, compress: bool = False):
+    """
+    Export core, recall and archival memory as NDJSON
+
+    :param session_id: Session ID for agent
+    :param compress: Gzip the exported stream
+    """
+    memgpt_api = MemGptAPI(session_id)
+    try:
+        # load before streaming, so a missing session is a 404 rather than a truncated 200
+        records = await anyio.to_thread.run_sync(memgpt_api.export_memory)
+    except SessionNotFound as err:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(err))
+
+    return ndjson_response(records, compress)
+
+
+@app.post("/memory/export", response_class=StreamingResponse)
+async def export_memories(export: MemoryExport):
+    """
+    Export memory of several sessions concurrently as NDJSON, each record tagged with its session
+
+    :param export: Session IDs to export
+    """
+    streams = {session_id: (lambda session_id=session_id: MemGptAPI(session_id).export_memory()) for session_id in export.sessions}
+    records = merge_session_records(streams, concurrency=EXPORT_CONCURRENCY)
+    return ndjson_response(records, export.compress)
+
+
+@app.post("/memory/{session_id}/import", response_model=MemoryImportStats)
+async def import_memory(session_id: str, request: Request):
+    """
+    Import NDJSON memory records, gzip or deflate encoded bodies are decompressed on the fly
+
+    :param session_id: Session ID for agent
+    """
+    compressed = request.headers.get("content-encoding", "").lower() in ("gzip", "deflate")
+    records = read_ndjson(request.stream(), compressed)
+
+    memgpt_api = MemGptAPI(session_id)
+    try:
+        async with worker.turn(session_id):
+            counts = await anyio.to_thread.run_sync(memgpt_api.import_memory, iterate_from_thread(records))
+    except WorkerDraining:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Worker is restarting", headers={"Retry-After": "1"})
+    except (NDJSONError, InvalidMemoryRecord) as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
+
+    return MemoryImportStats(**counts)
+
+
+@app.post("/memory/import", response_model=MemoriesImportStats)
+async def import_memories(request: Request):
+    """
+    Import a multi-session NDJSON export, routing each record to its session.
+    Records are spooled to disk per session first, then imported one session at a time.
+    Error records of the export, and sessions whose records are invalid, are reported in errors.
+    """
+    compressed = request.headers.get("content-encoding", "").lower() in ("gzip", "deflate")
+    records = read_ndjson(request.stream(), compressed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            files, errors = await anyio.to_thread.run_sync(spool_session_records, iterate_from_thread(records), directory)
+        except NDJSONError as err:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
+
+        sessions = {}
+        for session_id, filename in files.items():
+            memgpt_api = MemGptAPI(session_id)
+            try:
+                async with worker.turn(session_id):
+                    counts = await anyio.to_thread.run_sync(memgpt_api.import_memory, read_ndjson_file(filename))
+            except WorkerDraining:
+                # imports are idempotent, the client can resend the whole export
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Worker is restarting", headers={"Retry-After": "1"})
+            except InvalidMemoryRecord as err:
+                errors[session_id] = str(err)
+                continue
+            sessions[session_id] = MemoryImportStats(**counts)
+
+    return MemoriesImportStats(sessions=sessions, errors=errors)
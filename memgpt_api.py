@@ -3,8 +3,12 @@ import re
 
 import json
 import glob
+import pickle
+import time
+import threading
 
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 from datetime import date
 
 import memgpt.presets.presets as presets
@@ -12,15 +16,19 @@ from memgpt.memory import DummyRecallMemory as RecallMemory
 import openai
 
 from pathlib import Path
-from memgpt.agent import Agent
+from memgpt.agent import Agent, initialize_memory
 from memgpt.config import AgentConfig
+from memgpt.connectors.storage import Passage
 from memgpt.humans import humans
 from memgpt.interface import CLIInterface as interface
 from memgpt.persistence_manager import LocalStateManager
 from memgpt.personas import personas
+from memgpt.utils import count_tokens, get_local_time
 
 from dotenv import load_dotenv
 
+from capture import install_capture
+
 
 load_dotenv()
 os.environ['MEMGPT_CONFIG_PATH'] = Path.home().joinpath(
@@ -36,6 +44,39 @@ MODEL = os.getenv("MODEL", 'gpt-3.5-turbo-16k')
 PRESET = os.getenv("PRESET", presets.DEFAULT_PRESET)
 MODEL_ENDPOINT_TYPE = os.getenv("MODEL_ENDPOINT_TYPE", "openai")
 MODEL_ENDPOINT = os.getenv("MODEL_ENDPOINT", "https://api.openai.com/v1")
+ARCHIVAL_PAGE_SIZE = int(os.getenv("ARCHIVAL_PAGE_SIZE", 100))
+WARM_SESSIONS = int(os.getenv("WARM_SESSIONS", 100))
+LLM_CAPTURE_MODE = os.getenv("LLM_CAPTURE_MODE")
+LLM_CAPTURE_FILE = os.getenv("LLM_CAPTURE_FILE", "llm_capture.jsonl")
+LLM_REPLAY_SPEED = float(os.getenv("LLM_REPLAY_SPEED", 0))
+
+if LLM_CAPTURE_MODE:
+    install_capture(LLM_CAPTURE_MODE, LLM_CAPTURE_FILE, LLM_REPLAY_SPEED)
+
+
+class SessionNotFound(LookupError):
+    """Raised when a session has no saved state"""
+
+
+class InvalidMemoryRecord(ValueError):
+    """Raised when an imported memory record is malformed"""
+
+
+class CoreMemoryLimitExceeded(ValueError):
+    """Raised when a core memory edit exceeds the character limit of its block"""
+
+
+def validate_core_memory(core_memory: dict):
+    """
+    Build core memory, enforcing the persona and human character limits
+
+    :param core_memory: Core memory with persona and human
+    :return: Core memory object
+    """
+    try:
+        return initialize_memory(core_memory["persona"], core_memory["human"])
+    except ValueError as err:
+        raise CoreMemoryLimitExceeded(str(err))
 
 
 def parse_step(contents):
@@ -76,6 +117,162 @@ def parse_recall_memory_stats(recall_memory: RecallMemory) -> dict:
     return res
 
 
+def render_core_memory(system_message: str, core_memory: dict) -> Optional[str]:
+    """
+    Swap the core memory blocks of an already rendered system message, without re-rendering
+    the archival and recall memory statistics.
+
+    :param system_message: Rendered system message
+    :param core_memory: Core memory with persona and human
+    :return: Rendered system message with the new core memory, None unless each block was found exactly once
+    """
+    system_message = re.sub(r"### Memory \[last modified: [^\]]*\]", lambda _: f"### Memory [last modified: {get_local_time()}]", system_message, count=1)
+    for field in ("persona", "human"):
+        system_message, matches = re.subn(rf"<{field}>\n.*?\n</{field}>", lambda _: f"<{field}>\n{core_memory[field]}\n</{field}>", system_message, flags=re.DOTALL)
+        if matches != 1:
+            return None
+    return system_message
+
+
+class SystemPrompts():
+    """
+    Token count of the rendered system prompt per session, recomputed only when
+    the core memory it was rendered from changes. Least recently used entries are
+    dropped once more than max_size are held.
+
+    :param max_size: Maximum number of sessions held
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def tokens(self, session_id: str, core_memory: dict, system_message: str) -> int:
+        """
+        :param session_id: Session ID for agent
+        :param core_memory: Core memory the system message was rendered from
+        :param system_message: Rendered system message
+        :return: Token count of the system message
+        """
+        key = (core_memory["persona"], core_memory["human"])
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if entry is not None:
+                self.entries.move_to_end(session_id)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        tokens = count_tokens(system_message)
+        with self.lock:
+            self.entries[session_id] = (key, tokens)
+            self.entries.move_to_end(session_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return tokens
+
+    def forget(self, session_id: str) -> None:
+        with self.lock:
+            self.entries.pop(session_id, None)
+
+
+class WarmAgents():
+    """
+    Process wide cache of loaded agents, so turns do not cold-load from disk
+
+    Each agent remembers the mtime of the state file it matches, so a newer save by another
+    process is reloaded instead of overwritten. An agent is dirty between the start of a step
+    and its save, the least recently used clean agents are evicted once more than max_size are held.
+    Turns on a session are serialized by a lock striped over a fixed number of locks.
+
+    :param max_size: Maximum number of agents held in memory
+    :param lock_stripes: Number of session locks
+    """
+
+    def __init__(self, max_size: int, lock_stripes: int = 1024) -> None:
+        self.max_size = max_size
+        self.agents: OrderedDict = OrderedDict()
+        self.dirty = set()
+        self.closed = False
+        self.lock = threading.Lock()
+        self.session_locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def session_lock(self, session_id: str) -> threading.Lock:
+        return self.session_locks[hash(session_id) % len(self.session_locks)]
+
+    def get(self, session_id: str) -> Tuple[Optional[Agent], Optional[float]]:
+        """
+        :return: Warm agent and mtime of the state file it matches, (None, None) on a miss
+        """
+        with self.lock:
+            entry = self.agents.get(session_id)
+            if entry is None:
+                return None, None
+            self.agents.move_to_end(session_id)
+            return entry
+
+    def put(self, session_id: str, agent: Agent, mtime: Optional[float]) -> None:
+        with self.lock:
+            self.agents[session_id] = (agent, mtime)
+            self.agents.move_to_end(session_id)
+            # never evict the agent being inserted, even when every other one is dirty
+            clean = [key for key in self.agents if key not in self.dirty and key != session_id]
+            for key in clean[:max(0, len(self.agents) - self.max_size)]:
+                del self.agents[key]
+                system_prompts.forget(key)
+
+    def evict(self, session_id: str) -> None:
+        with self.lock:
+            self.agents.pop(session_id, None)
+            self.dirty.discard(session_id)
+        system_prompts.forget(session_id)
+
+    def mark_dirty(self, session_id: str) -> None:
+        with self.lock:
+            self.dirty.add(session_id)
+
+    def mark_clean(self, session_id: str) -> None:
+        with self.lock:
+            self.dirty.discard(session_id)
+
+    def sessions(self) -> List[str]:
+        """
+        :return: Warm session IDs, most recently used last
+        """
+        with self.lock:
+            return list(self.agents)
+
+    def flush(self, timeout: float) -> List[str]:
+        """
+        Close the cache and wait up to timeout for dirty agents to reach a consistent point.
+        Turns still running after that are abandoned: they will not save, the last save stays current.
+
+        :param timeout: Seconds to wait for in-flight turns
+        :return: Session IDs still in flight when the cache was closed
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            dirty = list(self.dirty)
+
+        abandoned = []
+        for session_id in dirty:
+            session_lock = self.session_lock(session_id)
+            if session_lock.acquire(timeout=max(0, deadline - time.monotonic())):
+                # the turn finished and saved (or was evicted) while we waited
+                session_lock.release()
+            else:
+                abandoned.append(session_id)
+
+        with self.lock:
+            self.closed = True
+            abandoned = [session_id for session_id in abandoned if session_id in self.dirty]
+        return abandoned
+
+
+warm_agents = WarmAgents(WARM_SESSIONS)
+system_prompts = SystemPrompts(WARM_SESSIONS)
+
+
 class MemGptAPI():
     """
     API for interacting with memgpt
@@ -93,7 +290,7 @@ class MemGptAPI():
             model_endpoint_type=MODEL_ENDPOINT_TYPE,
             model_endpoint=MODEL_ENDPOINT,
         )
-        self.persistence_manager = LocalStateManager(self.agent_config)
+        self.session_id = session_id
 
     def check_if_first_message(self) -> bool:
         """
@@ -105,6 +302,15 @@ class MemGptAPI():
         if not glob.glob(os.path.join(directory, "*.json")):
             return True
 
+    def latest_state_file(self) -> Optional[str]:
+        """
+        Get the latest saved agent state, the one Agent.load_agent would load
+
+        :return: Path of the state file, None if the agent was never saved
+        """
+        json_files = glob.glob(os.path.join(self.agent_config.save_state_dir(), "*.json"))
+        return max(json_files, key=os.path.getmtime) if json_files else None
+
     def init_agent(self) -> Agent:
         """
         Init agent 
@@ -118,10 +324,50 @@ class MemGptAPI():
             persona=PERSONA,
             human=HUMAN,
             interface=interface,
-            persistence_manager=self.persistence_manager,
+            persistence_manager=LocalStateManager(self.agent_config),
         )
         return agent
 
+    def get_agent(self) -> Agent:
+        """
+        Get warm agent, loading or initializing it on a miss or when a newer state was saved
+
+        :return: Agent
+        """
+        agent = self.fresh_warm_agent()
+        if agent is None:
+            latest_mtime = self.latest_state_mtime()
+            agent = self.init_agent() if latest_mtime is None else Agent.load_agent(interface, self.agent_config)
+            warm_agents.put(self.session_id, agent, latest_mtime)
+        return agent
+
+    def fresh_warm_agent(self) -> Optional[Agent]:
+        """
+        Get the warm agent unless another process saved a newer state since it was loaded
+
+        :return: Agent, None on a miss or if the warm agent is stale
+        """
+        agent, mtime = warm_agents.get(self.session_id)
+        latest_mtime = self.latest_state_mtime()
+        if agent is None or (latest_mtime is not None and (mtime is None or latest_mtime > mtime)):
+            return None
+        return agent
+
+    def latest_state_mtime(self) -> Optional[float]:
+        """
+        :return: mtime of the latest saved state, None if the agent was never saved
+        """
+        filename = self.latest_state_file()
+        return os.path.getmtime(filename) if filename else None
+
+    def warm(self) -> None:
+        """
+        Load an already persisted agent into the warm cache
+        """
+        if not self.check_if_first_message():
+            with warm_agents.session_lock(self.session_id):
+                self.get_agent()
+
     def send_message(self, prompt: str) -> str:
         """
         Send message for existing agent and return response
@@ -129,11 +375,20 @@ class MemGptAPI():
         :param prompt: Message to send to agent
         :return: Response from agent
         """
-        first = self.check_if_first_message()
-        agent = self.init_agent() if first else Agent.load_agent(interface, self.agent_config)
-
-        messages = agent.step(user_message=prompt, first_message=False, skip_verify=True)
-        agent.save()
+        with warm_agents.session_lock(self.session_id):
+            agent = self.get_agent()
+            warm_agents.mark_dirty(self.session_id)
+            try:
+                messages = agent.step(user_message=prompt, first_message=False, skip_verify=True)
+                if warm_agents.closed:
+                    raise RuntimeError("Worker shut down during the turn, it was not saved")
+                agent.save()
+            except Exception:
+                # drop the half-stepped agent, the next turn reloads the last save
+                warm_agents.evict(self.session_id)
+                raise
+            warm_agents.put(self.session_id, agent, self.latest_state_mtime())
+            warm_agents.mark_clean(self.session_id)
 
         return parse_step(messages)
 
@@ -162,3 +417,256 @@ class MemGptAPI():
         elif text_search:
             messages, count = agent.persistence_manager.recall_memory.text_search(text_search)
         return messages if messages else []
+
+
+    def get_core_memory(self) -> dict:
+        """
+        Get core memory from the warm agent, or from the saved state without loading the agent
+
+        :return: Core memory and token count of the rendered system prompt
+        """
+        agent = self.fresh_warm_agent()
+        if agent is not None:
+            core_memory, system_message = agent.memory.to_dict(), agent.messages[0]["content"]
+        else:
+            filename = self.latest_state_file()
+            if filename is None:
+                raise SessionNotFound(f"No saved state for session {self.session_id}")
+            with open(filename, "r") as file:
+                state = json.load(file)
+            core_memory, system_message = state["memory"], state["messages"][0]["content"]
+
+        tokens = system_prompts.tokens(self.session_id, core_memory, system_message)
+        return {**core_memory, "system_prompt_tokens": tokens}
+
+
+    def update_core_memory(self, persona: Optional[str] = None, human: Optional[str] = None) -> dict:
+        """
+        Edit core memory in place, on the warm agent or in the saved state
+
+        :param persona: New persona block, unchanged if None
+        :param human: New human block, unchanged if None
+        :return: Core memory and token count of the rendered system prompt
+        """
+        updates = {field: value for field, value in (("persona", persona), ("human", human)) if value is not None}
+
+        with warm_agents.session_lock(self.session_id):
+            agent = self.fresh_warm_agent()
+            if agent is not None:
+                core_memory = {**agent.memory.to_dict(), **updates}
+                if core_memory != agent.memory.to_dict():
+                    # validates the character limits before touching the agent
+                    agent.memory = validate_core_memory(core_memory)
+                    agent.rebuild_memory()
+                    agent.save()
+                    warm_agents.put(self.session_id, agent, self.latest_state_mtime())
+                return self.get_core_memory()
+
+            filename = self.latest_state_file()
+            if filename is None:
+                raise SessionNotFound(f"No saved state for session {self.session_id}")
+            with open(filename, "r") as file:
+                state = json.load(file)
+
+            core_memory = {**state["memory"], **updates}
+            if core_memory == state["memory"]:
+                return self.get_core_memory()
+
+            memory = validate_core_memory(core_memory)
+            system_message = render_core_memory(state["messages"][0]["content"], core_memory)
+            if system_message is None:
+                # the saved prompt does not have the layout we patch, let memgpt re-render it
+                agent = self.get_agent()
+                agent.memory = memory
+                agent.rebuild_memory()
+                agent.save()
+                warm_agents.put(self.session_id, agent, self.latest_state_mtime())
+            else:
+                state["memory"] = core_memory
+                state["messages"][0]["content"] = system_message
+
+                # same bookkeeping as swap_system_message: replace the first in-context
+                # message of the paired persistence manager and log the change to recall memory
+                pickle_file = os.path.join(
+                    self.agent_config.save_persistence_manager_dir(),
+                    os.path.basename(filename).replace(".json", ".persistence.pickle"),
+                )
+                with open(pickle_file, "rb") as file:
+                    data = pickle.load(file)
+                system_message = {"timestamp": get_local_time(), "message": state["messages"][0]}
+                data["messages"][0] = system_message
+                # recall memory shares this list once unpickled
+                data["all_messages"].append(system_message)
+
+                write_atomically(pickle_file, lambda file: pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL), binary=True)
+                write_atomically(filename, lambda file: json.dump(state, file))
+
+        return self.get_core_memory()
+
+
+    def export_memory(self) -> Iterator[dict]:
+        """
+        Load the saved agent and export its core, recall and archival memory one record at a time
+
+        :return: Iterator of memory records
+        """
+        if self.check_if_first_message():
+            raise SessionNotFound(f"No saved state for session {self.session_id}")
+        agent: Agent = Agent.load_agent(interface, self.agent_config)
+        return iter_memory_records(agent)
+
+
+    def import_memory(self, records: Iterable[dict]) -> dict:
+        """
+        Import memory records produced by export_memory into the agent.
+        Records already present are skipped, so importing the same export twice is a no-op.
+        The in-context window is only restored into a fresh session, an existing
+        session keeps its own ongoing conversation.
+
+        :param records: Iterable of memory records
+        :return: Number of imported records per memory type
+        """
+        # turns wait for the import, then reload the imported state from disk
+        with warm_agents.session_lock(self.session_id):
+            warm_agents.evict(self.session_id)
+            first = self.check_if_first_message()
+            agent = self.init_agent() if first else Agent.load_agent(interface, self.agent_config)
+            persistence_manager = agent.persistence_manager
+            archival_memory = persistence_manager.archival_memory
+
+            # the boot messages of a fresh agent go after the imported history
+            generated = list(persistence_manager.all_messages) if first else []
+            if first:
+                del persistence_manager.all_messages[:]
+
+            known_messages = {recall_key(message) for message in persistence_manager.all_messages}
+            known_passages = {
+                passage.text
+                for passages in archival_memory.storage.get_all_paginated(ARCHIVAL_PAGE_SIZE)
+                for passage in passages
+            }
+
+            counts = {"core": 0, "context": 0, "recall": 0, "archival": 0}
+            passages = []
+            for record in records:
+                record_type = validate_record(record, self.session_id)
+                if record_type == "context":
+                    if not first:
+                        continue
+                    agent._messages = record["messages"]
+                    agent.messages_total = record["messages_total"]
+                    timestamp = get_local_time()
+                    persistence_manager.messages = [{"timestamp": timestamp, "message": message} for message in record["messages"]]
+                elif record_type == "core":
+                    try:
+                        agent.memory.edit_persona(record["persona"])
+                        agent.memory.edit_human(record["human"])
+                    except ValueError as err:
+                        raise InvalidMemoryRecord(str(err))
+                elif record_type == "recall":
+                    message = {"timestamp": record["timestamp"], "message": record["message"]}
+                    if recall_key(message) in known_messages:
+                        continue
+                    known_messages.add(recall_key(message))
+                    # recall memory searches the same list, so appending is enough
+                    persistence_manager.all_messages.append(message)
+                elif record_type == "archival":
+                    if record["text"] in known_passages:
+                        continue
+                    known_passages.add(record["text"])
+                    if record.get("embedding") is None:
+                        archival_memory.insert(record["text"])
+                    else:
+                        passages.append(Passage(text=record["text"], embedding=record["embedding"], doc_id=f"agent_{self.agent_config.name}_memory"))
+                        if len(passages) >= ARCHIVAL_PAGE_SIZE:
+                            archival_memory.storage.insert_many(passages)
+                            passages = []
+                counts[record_type] += 1
+
+            # restored context replaces the boot messages, they were never seen by the exported agent
+            if not counts["context"]:
+                persistence_manager.all_messages.extend(generated)
+            if passages:
+                archival_memory.storage.insert_many(passages)
+            if counts["core"]:
+                agent.rebuild_memory()
+            agent.save()
+
+        return counts
+
+
+def write_atomically(filename: str, write: Callable, binary: bool = False) -> None:
+    """
+    Write a file through a temporary file, so readers never see it half-written
+
+    :param filename: Path of the file
+    :param write: Function writing the content to an open file
+    :param binary: Open the file in binary mode
+    """
+    tmp_file = f"{filename}.tmp"
+    with open(tmp_file, "wb" if binary else "w") as file:
+        write(file)
+    os.replace(tmp_file, filename)
+
+
+def iter_memory_records(agent: Agent) -> Iterator[dict]:
+    """
+    Iterate over core memory, in-context messages, recall and archival memory of a loaded agent
+
+    :param agent: Loaded agent
+    :return: Iterator of memory records
+    """
+    yield {"type": "core", **agent.memory.to_dict()}
+    yield {"type": "context", "messages": agent.messages, "messages_total": agent.messages_total}
+
+    for message in agent.persistence_manager.all_messages:
+        yield {"type": "recall", **message}
+
+    storage = agent.persistence_manager.archival_memory.storage
+    for passages in storage.get_all_paginated(ARCHIVAL_PAGE_SIZE):
+        for passage in passages:
+            embedding = [float(value) for value in passage.embedding] if passage.embedding is not None else None
+            yield {"type": "archival", "text": passage.text, "embedding": embedding}
+
+
+def recall_key(message: dict) -> tuple:
+    """
+    :param message: Recall memory entry with timestamp and message
+    :return: Key identifying the entry across exports
+    """
+    return message["timestamp"], json.dumps(message["message"], sort_keys=True)
+
+
+def validate_record(record, session_id: str) -> str:
+    """
+    Check an imported memory record has the fields of its type and belongs to the session
+
+    :param record: Decoded memory record
+    :param session_id: Session ID the records are imported into
+    :return: Record type
+    """
+    if not isinstance(record, dict):
+        raise InvalidMemoryRecord(f"Memory record must be an object, got {type(record).__name__}")
+    if "session" in record and record["session"] != session_id:
+        raise InvalidMemoryRecord(f"Memory record of session {record['session']} cannot be imported into session {session_id}, use POST /memory/import")
+
+    record_type = record.get("type")
+    fields = {
+        "core": {"persona": str, "human": str},
+        "context": {"messages": list, "messages_total": int},
+        "recall": {"timestamp": str, "message": dict},
+        "archival": {"text": str},
+    }.get(record_type)
+    if fields is None:
+        raise InvalidMemoryRecord(f"Unknown memory record type: {record_type}")
+
+    for field, field_type in fields.items():
+        if not isinstance(record.get(field), field_type):
+            raise InvalidMemoryRecord(f"Memory record of type {record_type} needs a {field_type.__name__} {field}")
+    if record_type == "context" and not (record["messages"] and all(isinstance(message, dict) for message in record["messages"]) and record["messages"][0].get("role") == "system"):
+        raise InvalidMemoryRecord("Context memory messages must be objects starting with the system message")
+    embedding = record.get("embedding")
+    if embedding is not None and not (isinstance(embedding, list) and all(isinstance(value, (int, float)) for value in embedding)):
+        raise InvalidMemoryRecord("Archival memory embedding must be a list of numbers")
+
+    return record_type
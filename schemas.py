@@ -1,3 +1,5 @@
+from typing import Dict, List, Optional
+
 from pydantic import BaseModel
 
 
@@ -16,3 +18,31 @@ class RecallMemoryStats(BaseModel):
     assistant: int
     function: int
     other: int
+
+
+class MemoryExport(BaseModel):
+    sessions: List[str]
+    compress: bool = False
+
+
+class MemoryImportStats(BaseModel):
+    core: int
+    context: int
+    recall: int
+    archival: int
+
+
+class MemoriesImportStats(BaseModel):
+    sessions: Dict[str, MemoryImportStats]
+    errors: Dict[str, str]
+
+
+class CoreMemory(BaseModel):
+    persona: str
+    human: str
+    system_prompt_tokens: int
+
+
+class CoreMemoryUpdate(BaseModel):
+    persona: Optional[str] = None
+    human: Optional[str] = None
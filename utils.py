@@ -1,5 +1,230 @@
+import os
+import json
+import zlib
+import asyncio
+import itertools
+from typing import AsyncIterator, Callable, Dict, Iterator, Tuple, Union
+
 import anyio
 
+# wbits for gzip output, and for auto-detecting gzip or zlib input
+GZIP_WBITS = 31
+AUTO_WBITS = 47
+# records moved per hop between the event loop and a worker thread
+BATCH_SIZE = 500
+# largest piece inflated at once, and longest accepted NDJSON line
+INFLATE_SIZE = 1 << 20
+MAX_LINE_SIZE = 64 << 20
+
+
+class NDJSONError(ValueError):
+    """Raised when an NDJSON body cannot be decoded"""
+
+
 async def stream_response(content: str):
     for line in content.split('\n'):
         yield f"{line}\n"
+
+
+async def stream_ndjson(records: Union[Iterator[dict], AsyncIterator[dict]], compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Stream records as NDJSON, one line per record
+
+    :param records: Records, blocking iterators are consumed in a worker thread
+    :param compress: Gzip the output
+    :return: Async iterator of encoded chunks
+    """
+    if not hasattr(records, "__aiter__"):
+        records = iterate_in_thread(records)
+
+    compressor = zlib.compressobj(wbits=GZIP_WBITS) if compress else None
+    async for record in records:
+        line = (json.dumps(record, default=str) + "\n").encode()
+        if compressor is None:
+            yield line
+        elif chunk := compressor.compress(line):
+            yield chunk
+
+    if compressor is not None:
+        yield compressor.flush()
+
+
+async def read_ndjson(chunks: AsyncIterator[bytes], compressed: bool = False) -> AsyncIterator[dict]:
+    """
+    Decode NDJSON records from a stream of chunks, inflating compressed bodies a bounded
+    piece at a time so memory stays flat whatever the compression ratio
+
+    :param chunks: Async iterator of raw chunks
+    :param compressed: Chunks are gzip or zlib compressed
+    :return: Async iterator of records
+    """
+    decompressor = zlib.decompressobj(wbits=AUTO_WBITS) if compressed else None
+    buffer = b""
+    line_number = 0
+
+    def decode(line: bytes):
+        try:
+            return json.loads(line)
+        except ValueError as err:
+            raise NDJSONError(f"Invalid JSON on line {line_number}: {err}")
+
+    def inflate(chunk: bytes) -> Iterator[bytes]:
+        nonlocal decompressor
+        data = chunk
+        while True:
+            if decompressor.eof:
+                data = decompressor.unused_data + data
+                if not data:
+                    return
+                # concatenated gzip members
+                decompressor = zlib.decompressobj(wbits=AUTO_WBITS)
+            piece = decompressor.decompress(data, INFLATE_SIZE)
+            data = decompressor.unconsumed_tail
+            if piece:
+                yield piece
+            elif not data and not decompressor.eof:
+                return
+
+    try:
+        async for chunk in chunks:
+            for piece in (inflate(chunk) if decompressor else [chunk]):
+                buffer += piece
+                *lines, buffer = buffer.split(b"\n")
+                if len(buffer) > MAX_LINE_SIZE:
+                    raise NDJSONError(f"Line {line_number + 1} is longer than {MAX_LINE_SIZE} bytes")
+                for line in lines:
+                    line_number += 1
+                    if line.strip():
+                        yield decode(line)
+    except zlib.error as err:
+        raise NDJSONError(f"Invalid compressed body: {err}")
+
+    if decompressor is not None and not decompressor.eof:
+        raise NDJSONError("Truncated compressed body")
+
+    line_number += 1
+    if buffer.strip():
+        yield decode(buffer)
+
+
+def spool_session_records(records: Iterator[dict], directory: str, batch_size: int = BATCH_SIZE) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Split records tagged with their session into one NDJSON file per session,
+    so interleaved multi-session exports can be imported one session at a time
+
+    :param records: Records tagged with their session
+    :param directory: Directory the per-session files are written to
+    :param batch_size: Number of lines buffered per session before appending them to its file
+    :return: File per session ID, and the error reported by the export per session ID
+    """
+    files: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    pending: Dict[str, list] = {}
+
+    def write(session_id: str):
+        with open(files[session_id], "a") as file:
+            file.writelines(pending.pop(session_id))
+
+    for record in records:
+        session_id = record.get("session") if isinstance(record, dict) else None
+        if not isinstance(session_id, str):
+            raise NDJSONError("Records of a multi-session import need a session")
+        if record.get("type") == "error":
+            errors[session_id] = str(record.get("error"))
+            continue
+
+        files.setdefault(session_id, os.path.join(directory, f"{len(files)}.ndjson"))
+        pending.setdefault(session_id, []).append(json.dumps(record) + "\n")
+        if len(pending[session_id]) >= batch_size:
+            write(session_id)
+
+    for session_id in list(pending):
+        write(session_id)
+    return files, errors
+
+
+def read_ndjson_file(filename: str) -> Iterator[dict]:
+    """
+    :param filename: NDJSON file written by spool_session_records
+    :return: Iterator of records
+    """
+    with open(filename, "r") as file:
+        for line in file:
+            yield json.loads(line)
+
+
+async def iterate_in_thread(records: Iterator[dict], batch_size: int = BATCH_SIZE) -> AsyncIterator[dict]:
+    """
+    Consume a blocking iterator in worker threads, a batch of records per thread hop
+
+    :param records: Blocking iterator of records
+    :param batch_size: Number of records pulled per hop
+    :return: Async iterator of records
+    """
+    def next_batch():
+        return list(itertools.islice(records, batch_size))
+
+    while batch := await anyio.to_thread.run_sync(next_batch):
+        for record in batch:
+            yield record
+
+
+def iterate_from_thread(records: AsyncIterator[dict], batch_size: int = BATCH_SIZE) -> Iterator[dict]:
+    """
+    Consume an async iterator from a worker thread started with anyio.to_thread,
+    a batch of records per round trip to the event loop
+
+    :param records: Async iterator living on the event loop
+    :param batch_size: Number of records pulled per round trip
+    :return: Blocking iterator of records
+    """
+    async def next_batch():
+        batch = []
+        try:
+            while len(batch) < batch_size:
+                batch.append(await records.__anext__())
+        except StopAsyncIteration:
+            pass
+        return batch
+
+    while batch := anyio.from_thread.run(next_batch):
+        yield from batch
+
+
+async def merge_session_records(streams: Dict[str, Callable[[], Iterator[dict]]], concurrency: int = 4, buffer_size: int = 100) -> AsyncIterator[dict]:
+    """
+    Consume several blocking record iterators concurrently, tagging each record with its session.
+    A session's iterator is only opened, in a worker thread, once a concurrency slot is free.
+
+    :param streams: Factory of the blocking iterator of records per session ID
+    :param concurrency: Maximum number of sessions read at the same time
+    :param buffer_size: Maximum number of records buffered between readers and consumer
+    :return: Async iterator of records in arrival order
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = object()
+
+    async def consume(session_id: str, open_records: Callable[[], Iterator[dict]]):
+        try:
+            async with semaphore:
+                records = await anyio.to_thread.run_sync(open_records)
+                async for record in iterate_in_thread(records):
+                    await queue.put({"session": session_id, **record})
+        except Exception as err:
+            await queue.put({"session": session_id, "type": "error", "error": str(err)})
+        finally:
+            await queue.put(done)
+
+    tasks = [asyncio.create_task(consume(session_id, open_records)) for session_id, open_records in streams.items()]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            record = await queue.get()
+            if record is done:
+                remaining -= 1
+            else:
+                yield record
+    finally:
+        for task in tasks:
+            task.cancel()